@@ -66,6 +66,7 @@ export class GraphDB {
       );
 
       CREATE INDEX IF NOT EXISTS idx_observations_session ON observations(session_key);
+      CREATE INDEX IF NOT EXISTS idx_observations_pending ON observations(processed_at) WHERE entities_json = '';
     `);
 
     // FTS5 virtual table for full-text search on nodes
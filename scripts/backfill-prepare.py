@@ -11,33 +11,63 @@ Usage:
                               [--recent-days N] [--chunk-size N]
 """
 
+import gzip
+import hashlib
+import itertools
 import json
 import os
-import glob
 import sqlite3
 import argparse
+import collections
 import re
+import mmap
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime, timedelta
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _JSONDecodeError = orjson.JSONDecodeError
+except ImportError:  # fall back to the stdlib parser
+    _json_loads = json.loads
+    _JSONDecodeError = json.JSONDecodeError
+
 DB_PATH = os.path.expanduser("~/.openclaw/memory/agentsense.db")
 SESSIONS_DIR = os.path.expanduser("~/.openclaw/agents/main/sessions/")
 MEMORY_DIR = os.path.expanduser("~/.openclaw/workspace/memory/")
 CHUNK_SIZE = 6000  # chars per observation (~1500 tokens)
 MIN_MSG_LEN = 80   # skip short messages
+# Shortest JSONL line that can still carry a MIN_MSG_LEN message
+MIN_LINE_LEN = MIN_MSG_LEN + len(b'{"role":"user","content":""}')
+READ_BLOCK_SIZE = 4 * 1024 * 1024  # bytes per bulk read of session files
+MMAP_THRESHOLD = 256 * 1024  # mmap memory files larger than this
+INSERT_BATCH_SIZE = 2000  # rows per write transaction
+MAX_WORKERS = min(os.cpu_count() or 1, 8)  # bound memory held by parallel session parsers
+MAX_IN_FLIGHT = 2 * MAX_WORKERS  # session files submitted but not yet consumed
+
+# Precompiled patterns used by clean_text. Both tag-delimited block types are
+# matched in a single alternation pass so each text is scanned once.
+_BLOCK_RE = re.compile(
+    r'(?P<kg><knowledge-graph-context>.*?</knowledge-graph-context>)'
+    r'|(?P<fr><function_results>.*?</function_results>)',
+    re.DOTALL,
+)
+_NL_RE = re.compile(r'\n{3,}')
+_JSON_META_OPEN = '```json\n{'
+_JSON_META_CLOSE = '}\n```'
 
 
 def extract_text_from_content(content):
     """Extract plain text from message content (string or list)."""
-    if isinstance(content, str):
+    # Exact type checks: content is always a plain str or list from JSON
+    if type(content) is str:
         return content
-    if isinstance(content, list):
-        texts = []
-        for item in content:
-            if isinstance(item, dict):
-                if item.get("type") == "text":
-                    texts.append(item.get("text", ""))
-        return "\n".join(texts)
+    if type(content) is list:
+        return "\n".join([
+            item.get("text", "") for item in content
+            if type(item) is dict and item.get("type") == "text"
+        ])
     return ""
 
 
@@ -55,83 +85,191 @@ def is_noise(text: str) -> bool:
     return False
 
 
+def _replace_block(match: re.Match) -> str:
+    return '[tool output]' if match.lastgroup == 'fr' else ''
+
+
+def _strip_json_meta(text: str) -> str:
+    """Remove ```json fenced blocks carrying a message_id (no nested braces)."""
+    out = []
+    copied = 0
+    pos = 0
+    while True:
+        start = text.find(_JSON_META_OPEN, pos)
+        if start < 0:
+            break
+        body = start + len(_JSON_META_OPEN)
+        end = text.find('}', body)
+        if end < 0:
+            break
+        if text.startswith(_JSON_META_CLOSE, end) and text.find('"message_id"', body, end) >= 0:
+            out.append(text[copied:start])
+            copied = pos = end + len(_JSON_META_CLOSE)
+        else:
+            pos = start + 1
+    if not out:
+        return text
+    out.append(text[copied:])
+    return ''.join(out)
+
+
 def clean_text(text: str) -> str:
     """Clean text for entity extraction."""
-    # Remove knowledge-graph-context blocks
-    text = re.sub(r'<knowledge-graph-context>.*?</knowledge-graph-context>', '', text, flags=re.DOTALL)
+    # Remove knowledge-graph-context blocks, replace tool results.
+    # Most messages contain neither marker, so skip the regex pass entirely.
+    if '<knowledge-graph-context>' in text or '<function_results>' in text:
+        text = _BLOCK_RE.sub(_replace_block, text)
     # Remove conversation metadata JSON blocks
-    text = re.sub(r'```json\n\{[^}]*"message_id"[^}]*\}\n```', '', text, flags=re.DOTALL)
-    # Remove tool result blocks
-    text = re.sub(r'<function_results>.*?</function_results>', '[tool output]', text, flags=re.DOTALL)
+    if '"message_id"' in text:
+        text = _strip_json_meta(text)
     # Collapse multiple newlines
-    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = _NL_RE.sub('\n\n', text)
     return text.strip()
 
 
+def _iter_paragraphs(text: str):
+    """Yield blank-line separated paragraphs without building the full list."""
+    start = 0
+    while True:
+        end = text.find("\n\n", start)
+        if end < 0:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 2
+
+
 def chunk_text(text: str, source: str, chunk_size: int = CHUNK_SIZE) -> list:
     """Split text into chunks with source attribution."""
     if len(text) <= chunk_size:
         return [(text, source)]
 
     chunks = []
-    paragraphs = text.split("\n\n")
-    current = ""
-
-    for para in paragraphs:
-        if len(current) + len(para) + 2 > chunk_size and current:
-            chunks.append((current.strip(), source))
-            current = para
+    # Accumulate parts and join on emit rather than growing a string.
+    # current_len is always len("\n\n".join(current_parts)); an empty
+    # accumulation is replaced rather than extended, as before.
+    current_parts = []
+    current_len = 0
+
+    for para in _iter_paragraphs(text):
+        if current_len and current_len + len(para) + 2 > chunk_size:
+            chunks.append(("\n\n".join(current_parts).strip(), source))
+            current_parts = [para]
+            current_len = len(para)
+        elif current_len:
+            current_parts.append(para)
+            current_len += len(para) + 2
         else:
-            current = current + "\n\n" + para if current else para
+            current_parts = [para]
+            current_len = len(para)
 
-    if current.strip():
-        chunks.append((current.strip(), source))
+    current = "\n\n".join(current_parts).strip()
+    if current:
+        chunks.append((current, source))
 
     return chunks
 
 
-def process_memory_files() -> list:
-    """Process all memory markdown files."""
-    chunks = []
-    patterns = [
-        os.path.join(MEMORY_DIR, "*.md"),
-        os.path.join(MEMORY_DIR, "kb", "*.md"),
-        os.path.join(MEMORY_DIR, "archive", "*.md"),
-        os.path.join(MEMORY_DIR, "archive", "**", "*.md"),
-    ]
-
-    seen_files = set()
-    for pattern in patterns:
-        for filepath in glob.glob(pattern, recursive=True):
-            if filepath in seen_files:
-                continue
-            seen_files.add(filepath)
+def _scan_md(dirpath: str):
+    """Yield non-hidden markdown files directly inside dirpath."""
+    try:
+        with os.scandir(dirpath) as it:
+            for e in it:
+                if e.name.endswith(".md") and not e.name.startswith(".") and e.is_file():
+                    yield e.path
+    except (FileNotFoundError, NotADirectoryError):
+        return
 
-            try:
-                with open(filepath, "r") as f:
-                    text = f.read()
-                if len(text.strip()) < MIN_MSG_LEN:
-                    continue
-                rel_path = os.path.relpath(filepath, MEMORY_DIR)
-                source = f"memory:{rel_path}"
-                text = clean_text(text)
-                chunks.extend(chunk_text(text, source))
-            except Exception as e:
-                print(f"  ⚠ Error reading {filepath}: {e}")
 
-    return chunks
+def _iter_memory_files():
+    """Yield top-level, kb/ and archive/ (recursive) markdown files."""
+    yield from _scan_md(MEMORY_DIR)
+    yield from _scan_md(os.path.join(MEMORY_DIR, "kb"))
+
+    # Follow symlinked directories like glob did, guarding against loops
+    seen_dirs = set()
+    for dirpath, dirnames, _ in os.walk(os.path.join(MEMORY_DIR, "archive"), followlinks=True):
+        real = os.path.realpath(dirpath)
+        if real in seen_dirs:
+            dirnames[:] = []
+            continue
+        seen_dirs.add(real)
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        yield from _scan_md(dirpath)
+
+
+def _read_memory_file(filepath) -> str:
+    """Read a memory file as text, mapping large ones instead of buffered reads."""
+    with open(filepath, "rb") as f:
+        if os.path.getsize(filepath) > MMAP_THRESHOLD:
+            # str() decodes straight from the mapping without an extra bytes copy
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                text = str(mm, "utf-8", "replace")
+        else:
+            text = f.read().decode("utf-8", "replace")
+    # Same newline handling as text-mode open() so paragraphs split on "\n\n"
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def process_memory_files():
+    """Process all memory markdown files, yielding chunks."""
+    for filepath in _iter_memory_files():
+        try:
+            text = _read_memory_file(filepath)
+            if len(text.strip()) < MIN_MSG_LEN:
+                continue
+            rel_path = os.path.relpath(filepath, MEMORY_DIR)
+            source = f"memory:{rel_path}"
+            text = clean_text(text)
+            yield from chunk_text(text, source)
+        except Exception as e:
+            print(f"  ⚠ Error reading {filepath}: {e}")
+
+
+def _iter_lines(f, block_size: int = READ_BLOCK_SIZE):
+    """Yield lines of a binary file from large block reads."""
+    # Pieces of a line spanning blocks are joined once its newline shows up,
+    # so very long lines are not re-copied on every block
+    pending = []
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        end = block.rfind(b"\n")
+        if end < 0:
+            pending.append(block)
+            continue
+        lines = block[:end].split(b"\n")
+        if pending:
+            pending.append(lines[0])
+            lines[0] = b"".join(pending)
+            pending = []
+        yield from lines
+        if end + 1 < len(block):
+            pending.append(block[end + 1:])
+    if pending:
+        yield b"".join(pending)
 
 
 def process_session_file(filepath: str) -> list:
     """Extract clean text from a single session JSONL file."""
     messages = []
+    seen_hashes = set()  # skip repeated messages (re-read files, repeated tool output)
     basename = os.path.basename(filepath)
 
     try:
-        with open(filepath, "r") as f:
-            for line in f:
+        # Archived sessions may be gzipped; decompress on the fly
+        opener = gzip.open if filepath.endswith(".gz") else open
+        with opener(filepath, "rb") as f:
+            for line in _iter_lines(f):
+                # Cheap byte checks before paying for a full JSON parse. These are
+                # C-level substring scans already; a JIT'd loop would not beat them.
+                if len(line) < MIN_LINE_LEN or b'"role"' not in line:
+                    continue
+                if b'"user"' not in line and b'"assistant"' not in line:
+                    continue
                 try:
-                    obj = json.loads(line)
+                    obj = _json_loads(line)
                     msg = obj.get("message", obj)
                     role = msg.get("role", "")
 
@@ -146,9 +284,13 @@ def process_session_file(filepath: str) -> list:
 
                     text = clean_text(text)
                     if len(text) >= MIN_MSG_LEN:
+                        h = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+                        if h in seen_hashes:
+                            continue
+                        seen_hashes.add(h)
                         prefix = "User" if role == "user" else "Assistant"
                         messages.append(f"[{prefix}]: {text}")
-                except (json.JSONDecodeError, KeyError):
+                except (_JSONDecodeError, KeyError):
                     continue
     except Exception as e:
         print(f"  ⚠ Error reading {filepath}: {e}")
@@ -163,54 +305,125 @@ def process_session_file(filepath: str) -> list:
     return chunk_text(full_text, source)
 
 
-def process_sessions(recent_days: int = None) -> list:
-    """Process session log files."""
-    files = sorted(
-        glob.glob(os.path.join(SESSIONS_DIR, "*.jsonl")),
-        key=os.path.getmtime,
-        reverse=True,
-    )
+def process_sessions(recent_days: int = None):
+    """Process session log files, yielding chunks."""
+    if not os.path.isdir(SESSIONS_DIR):
+        return
 
-    if recent_days:
-        cutoff = datetime.now() - timedelta(days=recent_days)
-        files = [f for f in files if datetime.fromtimestamp(os.path.getmtime(f)) >= cutoff]
+    # One stat per file: scandir entries cache the result
+    with os.scandir(SESSIONS_DIR) as it:
+        entries = [
+            (e.stat().st_mtime, e.path) for e in it
+            if e.name.endswith((".jsonl", ".jsonl.gz")) and not e.name.startswith(".")
+        ]
 
-    chunks = []
-    for filepath in files:
-        file_chunks = process_session_file(filepath)
-        chunks.extend(file_chunks)
-        if file_chunks:
-            print(f"  📄 {os.path.basename(filepath)}: {len(file_chunks)} chunks")
+    if recent_days:
+        cutoff = (datetime.now() - timedelta(days=recent_days)).timestamp()
+        entries = [(mt, path) for mt, path in entries if mt >= cutoff]
+
+    files = [path for _, path in sorted(entries, reverse=True)]
+
+    # Session files are independent, so parse them across processes. Only a
+    # bounded window of files is in flight, so finished results cannot pile
+    # up in the parent while the consumer is busy inserting.
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        pending_files = iter(files)
+        window = collections.deque(
+            (fp, ex.submit(process_session_file, fp))
+            for fp in itertools.islice(pending_files, MAX_IN_FLIGHT)
+        )
+        try:
+            while window:
+                filepath, future = window.popleft()
+                file_chunks = future.result()
+                for fp in itertools.islice(pending_files, 1):
+                    window.append((fp, ex.submit(process_session_file, fp)))
+                if file_chunks:
+                    print(f"  📄 {os.path.basename(filepath)}: {len(file_chunks)} chunks")
+                yield from file_chunks
+        except GeneratorExit:
+            # Consumer stopped early: drop queued files rather than parsing them
+            ex.shutdown(cancel_futures=True)
+            raise
+
+
+def _stage(heading: str, label: str, chunks, totals: dict):
+    """Pass a source's chunks through, printing progress and counting totals."""
+    print(heading)
+    count = 0
+    try:
+        for text, source in chunks:
+            count += 1
+            totals["chunks"] += 1
+            totals["chars"] += len(text)
+            yield text, source
+    finally:
+        chunks.close()
+    print(f"   → {count} chunks from {label}")
 
-    return chunks
 
+def insert_observations(chunks, dry_run: bool = False):
+    """Insert chunks into the observations table, consuming them lazily.
 
-def insert_observations(chunks: list, dry_run: bool = False):
-    """Insert chunks into the observations table."""
+    Returns False if an insert error aborted the run part way through.
+    """
     if dry_run:
-        print(f"\n🔍 DRY RUN — would insert {len(chunks)} observations")
-        for i, (text, source) in enumerate(chunks[:5]):
+        preview = []
+        count = 0
+        for chunk in chunks:
+            if count < 5:
+                preview.append(chunk)
+            count += 1
+        print(f"\n🔍 DRY RUN — would insert {count} observations")
+        for i, (text, source) in enumerate(preview):
             print(f"  [{i+1}] source={source} len={len(text)}")
             print(f"      {text[:100]}...")
-        if len(chunks) > 5:
-            print(f"  ... and {len(chunks) - 5} more")
-        return
+        if count > 5:
+            print(f"  ... and {count - 5} more")
+        return True
 
-    db = sqlite3.connect(DB_PATH)
+    session_key = f"backfill-{datetime.now():%Y%m%d}"
+    # Autocommit mode so the transaction below is managed explicitly.
+    # journal_mode=WAL matches the plugin's own setting; the other PRAGMAs
+    # only apply to this connection.
+    db = sqlite3.connect(DB_PATH, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-200000")
     inserted = 0
-    for text, source in chunks:
-        try:
-            db.execute(
-                "INSERT INTO observations (source, raw_text, entities_json, session_key) VALUES (?, ?, '', ?)",
-                (f"backfill:{source}", text, f"backfill-{datetime.now().strftime('%Y%m%d')}"),
-            )
-            inserted += 1
-        except Exception as e:
-            print(f"  ⚠ Insert error: {e}")
-
-    db.commit()
-    db.close()
+    chunks = iter(chunks)
+    try:
+        # Rows this run commits get ids above this (AUTOINCREMENT never reuses)
+        start_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM observations").fetchone()[0]
+        while True:
+            # Parse the next batch before taking the write lock, so the lock
+            # only covers the insert itself and the plugin can write in between
+            batch = list(itertools.islice(chunks, INSERT_BATCH_SIZE))
+            if not batch:
+                break
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                db.executemany(
+                    "INSERT INTO observations (source, raw_text, entities_json, session_key) VALUES (?, ?, '', ?)",
+                    [(f"backfill:{source}", text, session_key) for text, source in batch],
+                )
+                db.execute("COMMIT")
+            except Exception as e:
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                print(f"  ⚠ Insert error: {e}")
+                # Earlier batches stay committed; spell out how to undo them
+                print(f"\n⚠ Aborted after committing {inserted} observations; re-running will duplicate them.")
+                if inserted:
+                    print("   To remove them first:")
+                    print(f"   DELETE FROM observations WHERE id > {start_id} AND session_key = '{session_key}';")
+                return False
+            inserted += len(batch)
+    finally:
+        db.close()
     print(f"\n✅ Inserted {inserted} observations into agentsense.db")
+    return True
 
 
 def main():
@@ -225,34 +438,41 @@ def main():
     print("🧠 AgentSense Backfill Preprocessor")
     print(f"   DB: {DB_PATH}")
     print(f"   Chunk size: {args.chunk_size} chars")
-    print()
-
-    all_chunks = []
-
-    if not args.sessions_only:
-        print("📁 Processing memory files...")
-        memory_chunks = process_memory_files()
-        print(f"   → {len(memory_chunks)} chunks from memory files")
-        all_chunks.extend(memory_chunks)
-
-    if not args.memory_only:
-        print(f"\n📁 Processing session logs{f' (last {args.recent_days} days)' if args.recent_days else ''}...")
-        session_chunks = process_sessions(args.recent_days)
-        print(f"   → {len(session_chunks)} chunks from session logs")
-        all_chunks.extend(session_chunks)
-
-    total_chars = sum(len(t) for t, _ in all_chunks)
-    print(f"\n📊 Total: {len(all_chunks)} chunks, {total_chars:,} chars (~{total_chars // 4:,} tokens)")
 
     # Check current pending count
     if os.path.exists(DB_PATH):
         db = sqlite3.connect(DB_PATH)
+        # Served by the idx_observations_pending partial index from graph-db.ts
         pending = db.execute("SELECT COUNT(*) FROM observations WHERE entities_json = ''").fetchone()[0]
         total_obs = db.execute("SELECT COUNT(*) FROM observations").fetchone()[0]
         db.close()
         print(f"   Current DB: {total_obs} observations ({pending} pending)")
+    print()
+
+    # Chunks are streamed straight into the insert rather than collected first
+    totals = {"chunks": 0, "chars": 0}
+    stages = []
 
-    insert_observations(all_chunks, dry_run=args.dry_run)
+    if not args.sessions_only:
+        stages.append(_stage(
+            "📁 Processing memory files...", "memory files",
+            process_memory_files(), totals,
+        ))
+
+    if not args.memory_only:
+        stages.append(_stage(
+            f"\n📁 Processing session logs{f' (last {args.recent_days} days)' if args.recent_days else ''}...",
+            "session logs", process_sessions(args.recent_days), totals,
+        ))
+
+    completed = insert_observations(itertools.chain.from_iterable(stages), dry_run=args.dry_run)
+    # Stop any stage the insert abandoned (and its worker pool) right away
+    for stage in stages:
+        stage.close()
+
+    total_chars = totals["chars"]
+    label = "Total" if completed else "Processed before abort"
+    print(f"\n📊 {label}: {totals['chunks']} chunks, {total_chars:,} chars (~{total_chars // 4:,} tokens)")
 
 
 if __name__ == "__main__":